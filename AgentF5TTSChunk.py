@@ -2,26 +2,412 @@ import os
 import re
 import time
 import logging
+import threading
 import subprocess
+import weakref
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torchaudio
+import numpy as np
+import soundfile as sf
+from torch.nn.utils.rnn import pad_sequence
 from f5_tts.api import F5TTS 
+from f5_tts.infer.utils_infer import (
+    chunk_text,
+    cross_fade_duration,
+    hop_length,
+    load_checkpoint,
+    preprocess_ref_audio_text,
+    target_rms,
+    target_sample_rate,
+)
+from f5_tts.model.utils import convert_char_to_pinyin
 
 
 
 logging.basicConfig(level=logging.INFO)
 
+# Reference audio ready to be used as conditioning: mono, RMS-normalized, at the model sample rate.
+_Reference = namedtuple("_Reference", ["audio", "rms", "text"])
+
+# "[speaker:speaker_name, emotion:emotion_name]" line tag, the emotion being optional, plus the whitespace after it.
+_TAG_RE = re.compile(r"\[speaker:(.*?)(?:,\s*emotion:(.*?))?\]\s*")
+
+# Weight dtypes accepted by the `precision` argument of AgentF5TTS.
+_PRECISION_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+class AudioBufferPool:
+    """
+    Recycles float32 sample buffers so long conversations don't allocate a fresh array per turn.
+
+    `get` hands out a view of the smallest free buffer that fits (allocating one if none does);
+    `put` gives it back once the caller is done with it. Safe to use across threads.
+    """
+
+    def __init__(self, max_buffers=16):
+        self.max_buffers = max_buffers
+        self._free = []
+        self._lock = threading.Lock()
+
+    def get(self, n_samples):
+        with self._lock:
+            best = None
+            for i, buf in enumerate(self._free):
+                if buf.shape[0] >= n_samples and (best is None or buf.shape[0] < self._free[best].shape[0]):
+                    best = i
+            buf = self._free.pop(best) if best is not None else np.empty(n_samples, dtype=np.float32)
+        return buf[:n_samples]
+
+    def put(self, arr):
+        buf = arr if arr.base is None else arr.base
+        with self._lock:
+            if len(self._free) < self.max_buffers:
+                self._free.append(buf)
+
+
+class SpeakerRefTable:
+    """
+    Prepared references of several speakers, laid out as one padded tensor.
+
+    Row i of `audio` (zero-padded to the longest reference) belongs to `speaker_ids[i]`, with its
+    true sample count in `lengths[i]`, RMS in `rms[i]` and text in `texts[i]`. The agent turns the
+    rows into one padded device mel tensor once, and gathers each batch's conditioning from it.
+    """
+
+    def __init__(self, references):
+        """
+        :param references: Dictionary mapping speaker ids to references from `AgentF5TTS.prepare_reference`.
+        """
+        self.speaker_ids = list(references)
+        self.id2idx = {speaker: i for i, speaker in enumerate(self.speaker_ids)}
+        self.audio = pad_sequence([ref.audio for ref in references.values()], batch_first=True)
+        self.lengths = torch.tensor([ref.audio.shape[-1] for ref in references.values()], dtype=torch.long)
+        self.rms = [ref.rms for ref in references.values()]
+        self.texts = [ref.text for ref in references.values()]
+
+    def __len__(self):
+        return len(self.speaker_ids)
+
 
 class AgentF5TTS:
-    def __init__(self, ckpt_file, vocoder_name="vocos", delay=0, device="mps"):
+    def __init__(self, ckpt_file, vocoder_name="vocos", delay=0, device="mps", precision=None, compile=False):
         """
         Initialize the F5-TTS Agent.
 
         :param ckpt_file: Path to the safetensors model checkpoint.
         :param vocoder_name: Name of the vocoder to use ("vocos" or "bigvgan").
-        :param delay: Delay in seconds between audio generations.
+        :param delay: Minimum interval in seconds between the starts of two line generations in
+                      `generate_emotion_speech`. Only useful to pace output for live streaming;
+                      leave at 0 for batch jobs.
         :param device: Device to use ("cpu", "cuda", "mps").
+        :param precision: Weight precision of the DiT ("fp32", "fp16", "bf16"), or None to keep
+                          the F5-TTS default (FP16 on CUDA). The checkpoint is then loaded again
+                          straight into that dtype. The vocoder always stays in FP32.
+        :param compile: Compile the DiT with `torch.compile` (PyTorch 2.1+), with dynamic shapes. The
+                        first batches pay for the compilation; later ones reuse the compiled kernels
+                        whatever their padded length.
         """
+        if precision is not None and precision not in _PRECISION_DTYPES:
+            raise ValueError(f"Unsupported precision '{precision}', expected one of {list(_PRECISION_DTYPES)}.")
+
         self.model = F5TTS(ckpt_file=ckpt_file, vocoder_name=vocoder_name, device=device)
-        self.delay = delay  # Delay in seconds
+        if precision is not None:
+            # F5TTS already loaded the weights rounded to FP16 on CUDA, so casting them would not
+            # give back full precision (and BF16 would be rounded twice): reload the checkpoint into
+            # the requested dtype instead. The sampler casts its conditioning to the weight dtype
+            # and the output back to FP32
+            self.model.ema_model = load_checkpoint(
+                self.model.ema_model, ckpt_file, str(self.model.device), dtype=_PRECISION_DTYPES[precision]
+            )
+        if compile:
+            # Batch size and padded length change with almost every batch, so compile with dynamic
+            # shapes. No "reduce-overhead": it records a CUDA graph per distinct shape, which would mean
+            # a fresh capture (and more graph-pool memory) on nearly every batch
+            self.model.ema_model.transformer = torch.compile(
+                self.model.ema_model.transformer, fullgraph=False, dynamic=True
+            )
+        self.delay = delay  # Pacing interval in seconds, 0 disables it
+        self.device = self.model.device
+        # WAV export and MP3 encoding run here so the generation loop keeps feeding the model
+        self._post_pool = ThreadPoolExecutor(max_workers=2)
+        self._pending = []
+        self._buffer_pool = AudioBufferPool()
+        # Padded device mel spectrograms of each SpeakerRefTable, kept for the table's lifetime
+        self._ref_cache = weakref.WeakKeyDictionary()
+        # Generated chunks of split utterances, per output file, until all their siblings are in
+        self._partial = {}
+
+    def infer_batch(self, table, speakers, gen_texts, out_files=None, parts=None, nfe_step=32, cfg_strength=2.0,
+                    sway_sampling_coef=-1.0, speed=1.0):
+        """
+        Generate several utterances with a single F5-TTS forward pass.
+
+        The references are gathered from `table` into one padded conditioning batch and masked by their lengths.
+        Their mel spectrograms are computed on the device on the first call for a table and reused afterwards.
+
+        :param table: SpeakerRefTable holding the prepared reference of every speaker.
+        :param speakers: List of speaker ids (keys of `table`), one per utterance.
+        :param gen_texts: List of texts to generate, one per utterance.
+        :param out_files: Optional list of WAV paths to save each utterance to. Files are written
+                          in the background from pooled buffers; call `wait_pending` before reading them
+                          and to learn which ones failed.
+        :param parts: Optional list of (index, count) pairs, one per utterance, for texts split with
+                      `split_text`. Chunks of the same out_file may come in different batches; the file
+                      is written, cross-faded, once its last chunk has been generated. If a batch fails,
+                      pass its out_files to `discard_parts` before reusing those paths.
+        :return: List of generated waveforms (NumPy arrays at the model sample rate), or None when
+                 they are written to `out_files`.
+        """
+        idxs = [table.id2idx[speaker] for speaker in speakers]
+        pooled = out_files is not None
+        waves = self._infer_table(table, idxs, gen_texts, nfe_step, cfg_strength, sway_sampling_coef, speed, pooled)
+        if not pooled:
+            return waves
+
+        for i, (wave, out_file) in enumerate(zip(waves, out_files)):
+            if parts is not None and parts[i][1] > 1:
+                wave = self._collect_part(out_file, wave, *parts[i])
+                if wave is None:
+                    continue
+            self._pending.append((out_file, self._post_pool.submit(self._export_pooled_wav, wave, out_file)))
+
+    def split_text(self, table, speaker, text):
+        """
+        Split `text` into chunks short enough for `speaker`'s reference, at punctuation.
+
+        Uses the same budget as `F5TTS.infer`: reference plus generated audio stays around 25 s,
+        so attention cost and memory don't grow with the square of very long sentences.
+        """
+        idx = table.id2idx[speaker]
+        ref_seconds = table.lengths[idx].item() / target_sample_rate
+        max_chars = int(len(table.texts[idx].encode("utf-8")) / ref_seconds * (25 - ref_seconds))
+        return chunk_text(text, max_chars=max_chars) or [text]
+
+    def generate_speech_from_array(self, text_file, output_audio_file, ref_audio, ref_text, sr, convert_to_mp3=False):
+        """
+        Generate speech from an in-memory reference waveform.
+
+        Works like `generate_speech`, but the reference never goes through a WAV file and
+        the generated lines are joined in memory before the single output write.
+
+        :param text_file: Path to the input text file.
+        :param output_audio_file: Path to save the combined audio output.
+        :param ref_audio: Reference waveform as a NumPy array.
+        :param ref_text: Transcript of the reference waveform.
+        :param sr: Sample rate of `ref_audio`.
+        :param convert_to_mp3: Boolean flag to convert the output to MP3.
+        """
+        try:
+            with open(text_file, 'r', encoding='utf-8') as file:
+                lines = [line.strip() for line in file if line.strip()]
+        except FileNotFoundError:
+            logging.error(f"Text file not found: {text_file}")
+            return
+
+        if not lines:
+            logging.error("Input text file is empty.")
+            return
+
+        os.makedirs(os.path.dirname(output_audio_file), exist_ok=True)
+        table = SpeakerRefTable({"ref": self.prepare_reference(ref_audio, ref_text, sr)})
+
+        waves = []
+        for i, line in enumerate(lines):
+            try:
+                logging.info(f"Generating speech for line {i + 1}: '{line}'")
+                waves.append(self._infer_line(table, "ref", line))
+            except Exception as e:
+                logging.error(f"Error generating speech for line {i + 1}: {e}")
+
+        if not waves:
+            logging.error("No audio files to combine.")
+            return
+
+        self._export_wav(np.concatenate(waves), output_audio_file)
+        for wave in waves:
+            self._buffer_pool.put(wave)
+        if convert_to_mp3:
+            self._queue_mp3(output_audio_file)
+
+    def _infer_line(self, table, speaker, line):
+        """Generate one line with `speaker`'s row of `table`, split and cross-faded, into a pooled buffer."""
+        chunks = self.split_text(table, speaker, line)
+        return self._crossfade(self._infer_table(table, [table.id2idx[speaker]] * len(chunks), chunks, pooled=True))
+
+    def _infer_table(self, table, idxs, gen_texts, nfe_step=32, cfg_strength=2.0, sway_sampling_coef=-1.0, speed=1.0,
+                     pooled=False):
+        """
+        Run one batched sampling + vocoding pass over rows `idxs` of a SpeakerRefTable.
+        With `pooled`, the waveforms are copied into buffers from the agent's pool, to be `put` back by the caller.
+        """
+        rows = torch.tensor(idxs, dtype=torch.long)
+        ref_lens = (table.lengths[rows] // hop_length).tolist()
+        # Already a mel batch, so the sampler skips its own STFT of the reference
+        cond = self._reference_mels(table).index_select(0, rows.to(self.device))[:, :max(ref_lens)]
+
+        ref_texts = [table.texts[i] for i in idxs]
+        durations = [self._estimate_duration(ref_len, ref_text, gen_text, speed)
+                     for ref_len, ref_text, gen_text in zip(ref_lens, ref_texts, gen_texts)]
+        text_list = convert_char_to_pinyin([ref_text + gen_text for ref_text, gen_text in zip(ref_texts, gen_texts)])
+
+        waves = []
+        with torch.inference_mode():
+            generated, _ = self.model.ema_model.sample(
+                cond=cond,
+                text=text_list,
+                duration=torch.tensor(durations, dtype=torch.long, device=self.device),
+                lens=torch.tensor(ref_lens, dtype=torch.long, device=self.device),
+                steps=nfe_step,
+                cfg_strength=cfg_strength,
+                sway_sampling_coef=sway_sampling_coef,
+            )
+            generated = generated.to(torch.float32)
+
+            for i, idx in enumerate(idxs):
+                # Drop the reference prompt and the padding past this row's own duration
+                generated_mel_spec = generated[i:i + 1, ref_lens[i]:durations[i], :].permute(0, 2, 1)
+                if self.model.mel_spec_type == "bigvgan":
+                    generated_wave = self.model.vocoder(generated_mel_spec)
+                else:
+                    generated_wave = self.model.vocoder.decode(generated_mel_spec)
+                if table.rms[idx] < target_rms:
+                    generated_wave = generated_wave * table.rms[idx] / target_rms
+                generated_wave = generated_wave.squeeze()
+                if pooled:
+                    wave = self._buffer_pool.get(generated_wave.shape[-1])
+                    torch.from_numpy(wave).copy_(generated_wave)
+                    waves.append(wave)
+                else:
+                    waves.append(generated_wave.cpu().numpy())
+
+        return waves
+
+    def _collect_part(self, out_file, wave, index, count):
+        """Hold chunk `index` of `count` for `out_file`; once all are in, return them cross-faded."""
+        pieces = self._partial.setdefault(out_file, [None] * count)
+        pieces[index] = wave
+        if any(piece is None for piece in pieces):
+            return None
+        del self._partial[out_file]
+        return self._crossfade(pieces)
+
+    def discard_parts(self, out_files):
+        """Drop the chunks held for `out_files` by `infer_batch`, e.g. after a batch of theirs failed."""
+        for out_file in out_files:
+            for piece in self._partial.pop(out_file, ()):
+                if piece is not None:
+                    self._buffer_pool.put(piece)
+
+    def _crossfade(self, pieces):
+        """
+        Join pooled waveform chunks with a linear cross-fade, as `F5TTS.infer` does, into one pooled
+        buffer. The chunk buffers go back to the pool.
+        """
+        if len(pieces) == 1:
+            return pieces[0]
+
+        max_fade = int(cross_fade_duration * target_sample_rate)
+        fades = []
+        total = len(pieces[0])
+        for piece in pieces[1:]:
+            fades.append(min(max_fade, total, len(piece)))
+            total += len(piece) - fades[-1]
+        wave = self._buffer_pool.get(total)
+
+        pos = len(pieces[0])
+        wave[:pos] = pieces[0]
+        for piece, fade in zip(pieces[1:], fades):
+            if fade > 0:
+                fade_in = np.linspace(0, 1, fade, dtype=np.float32)
+                wave[pos - fade:pos] = wave[pos - fade:pos] * (1 - fade_in) + piece[:fade] * fade_in
+            wave[pos:pos + len(piece) - fade] = piece[fade:]
+            pos += len(piece) - fade
+
+        for piece in pieces:
+            self._buffer_pool.put(piece)
+        return wave
+
+    def _reference_mels(self, table):
+        """
+        Return the mel spectrograms of all references in `table` as one zero-padded device tensor
+        ([rows, frames, n_mels]), computing it on first use. Each reference is uploaded and transformed
+        on its own, so the STFT never runs over the whole padded table at once.
+        """
+        mels = self._ref_cache.get(table)
+        if mels is None:
+            ema_model = self.model.ema_model
+            n_frames = int(table.lengths.max()) // hop_length + 1
+            with torch.inference_mode():
+                mels = torch.zeros((len(table), n_frames, ema_model.num_channels),
+                                   dtype=next(ema_model.parameters()).dtype, device=self.device)
+                for idx in range(len(table)):
+                    audio = table.audio[idx:idx + 1, :int(table.lengths[idx])].to(self.device)
+                    mel = ema_model.mel_spec(audio)[0].T
+                    mels[idx, :mel.shape[0]] = mel
+            self._ref_cache[table] = mels
+        return mels
+
+    def wait_pending(self):
+        """
+        Block until all background WAV exports and MP3 encodes have finished.
+
+        :return: Set of the files whose background write failed (already logged).
+        """
+        pending, self._pending = self._pending, []
+        return {out_file for out_file, future in pending if future.exception() is not None}
+
+    def _queue_mp3(self, wav_file):
+        """Queue the MP3 encode of `wav_file` on the post-processing pool."""
+        mp3_output = wav_file.replace(".wav", ".mp3")
+        self._pending.append((mp3_output, self._post_pool.submit(self._encode_mp3, wav_file, mp3_output)))
+
+    def estimate_frames(self, table, speaker, text, speed=1.0):
+        """Estimated mel frames (reference + generated) of the DiT sequence for `text` spoken by `speaker`."""
+        idx = table.id2idx[speaker]
+        return self._estimate_duration(int(table.lengths[idx]) // hop_length, table.texts[idx], text, speed)
+
+    def prepare_reference(self, ref_audio, ref_text, sr=None):
+        """
+        Load and normalize a reference the same way `F5TTS.infer` does, ready for a SpeakerRefTable.
+
+        `ref_audio` is a path or a waveform array sampled at `sr`. Paths go through
+        `preprocess_ref_audio_text`. Arrays are used directly: they are clipped to 15 s
+        but not silence-trimmed, and need a transcript. The audio stays on the CPU.
+        """
+        if isinstance(ref_audio, str):
+            ref_file, ref_text = preprocess_ref_audio_text(ref_audio, ref_text)
+            audio, sr = torchaudio.load(ref_file)
+        else:
+            if not ref_text.strip():
+                raise ValueError("A reference text is required for in-memory reference audio.")
+            audio = torch.as_tensor(ref_audio, dtype=torch.float32)
+            audio = audio.unsqueeze(0) if audio.ndim == 1 else audio.T  # (frames, channels) -> (channels, frames)
+            audio = audio[:, :15 * sr]
+            if not ref_text.endswith(". ") and not ref_text.endswith("。"):
+                ref_text += " " if ref_text.endswith(".") else ". "
+
+        if audio.shape[0] > 1:
+            audio = torch.mean(audio, dim=0, keepdim=True)
+
+        rms = torch.sqrt(torch.mean(torch.square(audio))).item()
+        if rms < target_rms:
+            audio = audio * target_rms / rms
+        if sr != target_sample_rate:
+            audio = torchaudio.transforms.Resample(sr, target_sample_rate)(audio)
+
+        if len(ref_text[-1].encode("utf-8")) == 1:
+            ref_text = ref_text + " "
+        return _Reference(audio.squeeze(0), rms, ref_text)
+
+    def _estimate_duration(self, ref_audio_len, ref_text, gen_text, speed):
+        """Estimate the total mel frames (reference + generated) from the reference speaking rate."""
+        if len(gen_text.encode("utf-8")) < 10:
+            speed = 0.3
+        ref_text_len = len(ref_text.encode("utf-8"))
+        gen_text_len = len(gen_text.encode("utf-8"))
+        return ref_audio_len + int(ref_audio_len / ref_text_len * gen_text_len / speed)
 
     def generate_emotion_speech(self, text_file, output_audio_file, speaker_emotion_refs, convert_to_mp3=False):
         """
@@ -43,35 +429,45 @@ class AgentF5TTS:
             logging.error("Input text file is empty.")
             return
 
-        temp_files = []
+        exports = []
         os.makedirs(os.path.dirname(output_audio_file), exist_ok=True)
+        tagged = [self._determine_speaker_emotion(line) for line in lines]
 
-        for i, line in enumerate(lines):
+        # Stat, preprocess and mel-encode each reference file once, not once per line
+        refs = {}
+        for ref_audio in sorted({speaker_emotion_refs.get((speaker, emotion)) for speaker, emotion, _ in tagged} - {None}):
+            if not os.path.exists(ref_audio):
+                continue
+            try:
+                refs[ref_audio] = self.prepare_reference(ref_audio, "")  # Empty text: F5-TTS transcribes it
+            except Exception as e:
+                logging.error(f"Error preparing reference audio {ref_audio}: {e}")
+        table = SpeakerRefTable(refs) if refs else None
+        next_start = time.monotonic()
+
+        for i, (speaker, emotion, line) in enumerate(tagged):
             
-            speaker, emotion = self._determine_speaker_emotion(line)
             ref_audio = speaker_emotion_refs.get((speaker, emotion))
-            line = re.sub(r'\[speaker:.*?\]\s*', '', line)
-            if not ref_audio or not os.path.exists(ref_audio):
+            if ref_audio not in refs:
                 logging.error(f"Reference audio not found for speaker '{speaker}', emotion '{emotion}'.")
                 continue
 
-            ref_text = ""  # Placeholder or load corresponding text
             temp_file = f"{output_audio_file}_line{i + 1}.wav"
 
+            if self.delay:
+                # Pace against the clock instead of idling after every line: only the part of the
+                # interval not already spent generating (and exporting in the background) is waited out
+                time.sleep(max(0.0, next_start - time.monotonic()))
+                next_start = time.monotonic() + self.delay
+
             try:
                 logging.info(f"Generating speech for line {i + 1}: '{line}' with speaker '{speaker}', emotion '{emotion}'")
-                self.model.infer(
-                    ref_file=ref_audio,
-                    ref_text=ref_text,
-                    gen_text=line,
-                    file_wave=temp_file,
-                    remove_silence=True,
-                )
-                temp_files.append(temp_file)
-                time.sleep(self.delay)
+                wave = self._infer_line(table, ref_audio, line)
+                exports.append((temp_file, self._post_pool.submit(self._export_pooled_wav, wave, temp_file, True)))
             except Exception as e:
                 logging.error(f"Error generating speech for line {i + 1}: {e}")
 
+        temp_files = [temp for temp, future in exports if future.exception() is None]
         self._combine_audio_files(temp_files, output_audio_file, convert_to_mp3)
 
 
@@ -88,29 +484,33 @@ class AgentF5TTS:
             logging.error("Input text file is empty.")
             return
 
-        temp_files = []
+        # The reference is the same for every line, so check it once up front
+        if not ref_audio or not os.path.exists(ref_audio):
+            logging.error(f"Reference audio not found for speaker.")
+            return
+
+        exports = []
         os.makedirs(os.path.dirname(output_audio_file), exist_ok=True)
+        # Preprocess and mel-encode the reference once for all lines
+        try:
+            table = SpeakerRefTable({"ref": self.prepare_reference(ref_audio, ref_text)})
+        except Exception as e:
+            logging.error(f"Error preparing reference audio {ref_audio}: {e}")
+            return
 
         for i, line in enumerate(lines):
             
-            if not ref_audio or not os.path.exists(ref_audio):
-                logging.error(f"Reference audio not found for speaker.")
-                continue
             temp_file = f"{output_audio_file}_line{i + 1}.wav"
 
             try:
                 logging.info(f"Generating speech for line {i + 1}: '{line}'")
-                self.model.infer(
-                    ref_file=ref_audio,  # No reference audio
-                    ref_text= ref_text,  # No reference text
-                    gen_text=line,
-                    file_wave=temp_file,
-                )
-                temp_files.append(temp_file)
+                wave = self._infer_line(table, "ref", line)
+                exports.append((temp_file, self._post_pool.submit(self._export_pooled_wav, wave, temp_file)))
             except Exception as e:
                 logging.error(f"Error generating speech for line {i + 1}: {e}")
 
         # Combine temp_files into output_audio_file if needed
+        temp_files = [temp for temp, future in exports if future.exception() is None]
         self._combine_audio_files(temp_files, output_audio_file, convert_to_mp3)
 
 
@@ -118,40 +518,70 @@ class AgentF5TTS:
 
     def _determine_speaker_emotion(self, text):
         """
-        Extract speaker and emotion from the text using regex.
+        Extract speaker and emotion from the text and strip every speaker tag from it, in a single regex scan.
         Default to "speaker1" and "neutral" if not specified.
         """
-        speaker, emotion = "speaker1", "neutral"  # Default values
+        found = []
 
-        # Use regex to find [speaker:speaker_name, emotion:emotion_name]
-        match = re.search(r"\[speaker:(.*?), emotion:(.*?)\]", text)
-        if match:
-            speaker = match.group(1).strip()
-            emotion = match.group(2).strip()
+        def take_tag(match):
+            # The first [speaker:speaker_name, emotion:emotion_name] tag sets both fields;
+            # every tag, speaker-only ones included, is cut out so none is read out loud
+            if not found and match.group(2) is not None:
+                found.append((match.group(1).strip(), match.group(2).strip()))
+            return ""
+
+        text = _TAG_RE.sub(take_tag, text)
+        speaker, emotion = found[0] if found else ("speaker1", "neutral")  # Default values
 
         logging.info(f"Determined speaker: '{speaker}', emotion: '{emotion}'")
-        return speaker, emotion
+        return speaker, emotion, text
+
+    def _export_wav(self, wav, file_wave, remove_silence=False):
+        """Write a generated waveform to disk. Runs on the post-processing pool."""
+        try:
+            self.model.export_wav(wav, file_wave, remove_silence)
+        except Exception as e:
+            logging.error(f"Error writing audio file {file_wave}: {e}")
+            raise
+
+    def _export_pooled_wav(self, wav, file_wave, remove_silence=False):
+        """Write a waveform held in a pooled buffer, then hand the buffer back to the pool."""
+        try:
+            self._export_wav(wav, file_wave, remove_silence)
+        finally:
+            self._buffer_pool.put(wav)
+
+    def _encode_mp3(self, wav_file, mp3_output):
+        """Encode a WAV file to MP3 using FFmpeg. Runs on the post-processing pool."""
+        try:
+            subprocess.run(["ffmpeg", "-y", "-i", wav_file, "-codec:a", "libmp3lame", "-qscale:a", "2", "-threads", "0", mp3_output], check=True)
+            logging.info(f"Converted to MP3: {mp3_output}")
+        except Exception as e:
+            logging.error(f"Error converting {wav_file} to MP3: {e}")
+            raise
 
     def _combine_audio_files(self, temp_files, output_audio_file, convert_to_mp3):
-        """Combine multiple audio files into a single file using FFmpeg."""
+        """
+        Concatenate the generated WAV segments in-process, streaming them into a single output file.
+        The MP3 encode, if requested, is queued on the post-processing pool (see `wait_pending`).
+        """
         if not temp_files:
             logging.error("No audio files to combine.")
             return
 
-        list_file = "file_list.txt"
-        with open(list_file, "w") as f:
-            for temp in temp_files:
-                f.write(f"file '{temp}'\n")
-
         try:
-            subprocess.run(["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy", output_audio_file], check=True)
-            if convert_to_mp3:
-                mp3_output = output_audio_file.replace(".wav", ".mp3")
-                subprocess.run(["ffmpeg", "-y", "-i", output_audio_file, "-codec:a", "libmp3lame", "-qscale:a", "2", mp3_output], check=True)
-                logging.info(f"Converted to MP3: {mp3_output}")
+            # Stream the segments into one output file block by block, so only one block is in memory
+            info = sf.info(temp_files[0])
+            with sf.SoundFile(output_audio_file, "w", samplerate=info.samplerate, channels=info.channels,
+                              format="WAV", subtype="PCM_16") as out:
+                for temp in temp_files:
+                    with sf.SoundFile(temp) as src:
+                        for block in src.blocks(blocksize=65536, dtype="int16"):
+                            out.write(block)
             for temp in temp_files:
                 os.remove(temp)
-            os.remove(list_file)
+            if convert_to_mp3:
+                self._queue_mp3(output_audio_file)
         except Exception as e:
             logging.error(f"Error combining audio files: {e}")
 
@@ -169,7 +599,7 @@ if __name__ == "__main__":
         ("speaker1", "sad"): "ref_audios/speaker1_sad.wav",
         ("speaker1", "angry"): "ref_audios/speaker1_angry.wav",
     }
-    agent = AgentF5TTS(ckpt_file=model_path, vocoder_name="vocos", delay=6)
+    agent = AgentF5TTS(ckpt_file=model_path, vocoder_name="vocos")
     
     agent.generate_emotion_speech(
         text_file="input_text.txt",
@@ -184,6 +614,7 @@ if __name__ == "__main__":
         ref_audio="ref_audios/refaudio.mp3",
         convert_to_mp3=True,
     )
+    agent.wait_pending()
 
 
 
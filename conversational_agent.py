@@ -1,16 +1,18 @@
 import os
 import yaml
-import tempfile
 import numpy as np
 import pandas as pd
-import soundfile as sf
 import argparse
 import json
 import logging
+import functools
+import torch
+import torch.multiprocessing as mp
 from pathlib import Path
+from collections import namedtuple
 from datasets import load_dataset
 from cached_path import cached_path
-from AgentF5TTSChunk import AgentF5TTS
+from AgentF5TTSChunk import AgentF5TTS, SpeakerRefTable
 
 # Default model configuration for Brazilian Portuguese
 DEFAULT_TTS_MODEL = "F5-TTS-BR"
@@ -19,99 +21,194 @@ DEFAULT_TTS_MODEL_CFG = [
     json.dumps(dict(dim=1024, depth=22, heads=16, ff_mult=2, text_dim=512, conv_layers=4)),
 ]
 
+# About 175 s of padded reference + generated audio per forward pass
+DEFAULT_MAX_FRAMES_PER_BATCH = 16384
+
+# Remembers where cached_path put each checkpoint, so warm runs skip the remote check
+CHECKPOINT_MANIFEST = Path.home() / ".cache" / "f5-conv" / "checkpoints.json"
+
+# One piece of a dialog turn to synthesize: its text, speaker, output file, estimated mel frames,
+# and (index, count) among the pieces its turn was split into
+TurnChunk = namedtuple("TurnChunk", ["gen_text", "speaker", "output_path", "n_frames", "part"])
+
 logging.basicConfig(level=logging.INFO)
 
-def get_reference_audio(speaker_id, dataset):
-    """Get reference audio and text for a specific speaker"""
-    for item in dataset:
-        if item['filepath'] == speaker_id:
-            return item['audio']['array'], item['text']
-    return None, None
+@functools.lru_cache(maxsize=1)
+def _get_dataset(name="freds0/BRSpeech-TTS-Leni", split="test"):
+    """Load the reference dataset once per process, backed by the memory-mapped Arrow cache"""
+    return load_dataset(name, split=split).with_format("numpy")
+
+def resolve_checkpoint(uri):
+    """Return a local path for a checkpoint URI, reusing the path recorded by a previous run"""
+    try:
+        with open(CHECKPOINT_MANIFEST, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
 
-def assign_speaker_voices(speakers, dataset):
-    """Assign a unique reference voice and text to each speaker"""
+    local_path = manifest.get(uri)
+    if local_path and os.path.exists(local_path):
+        return local_path
+
+    local_path = str(cached_path(uri))
+    manifest[uri] = local_path
+    CHECKPOINT_MANIFEST.parent.mkdir(parents=True, exist_ok=True)
+    with open(CHECKPOINT_MANIFEST, 'w') as f:
+        json.dump(manifest, f)
+    return local_path
+
+def assign_speaker_voices(speakers, dataset, needed=None):
+    """
+    Assign a unique reference voice and text to each speaker.
+
+    Voices are picked from the position of each speaker in the sorted `speakers`, but only those
+    of the `needed` speakers (default: all of them) are decoded and returned.
+    """
     speaker_voices = {}
     speaker_texts = {}
-    speaker_ids = list(set(speakers))
-    
-    # Get all available reference audios and texts from the dataset
-    available_references = []
-    available_texts = []
-    for item in dataset:
-        available_references.append(item['audio']['array'])
-        available_texts.append(item['text'])
-    
-    # Assign references in a round-robin fashion
-    for i, speaker in enumerate(speaker_ids):
-        if available_references:  # Make sure we have references available
-            ref_audio = available_references[i % len(available_references)]
-            ref_text = available_texts[i % len(available_texts)]
-            speaker_voices[speaker] = ref_audio
-            speaker_texts[speaker] = ref_text
+    speaker_ids = sorted(set(speakers))  # Sorted so every GPU worker assigns the same voices
+    if not speaker_ids or len(dataset) == 0:
+        return speaker_voices, speaker_texts
+
+    needed = speaker_ids if needed is None else sorted(set(needed))
+    position = {speaker: i for i, speaker in enumerate(speaker_ids)}
+    # Assign references in a round-robin fashion, decoding only the rows actually picked
+    picks = dataset.select([position[speaker] % len(dataset) for speaker in needed])
+    for speaker, item in zip(needed, picks):
+        speaker_voices[speaker] = item['audio']['array']
+        speaker_texts[speaker] = item['text']
     
     return speaker_voices, speaker_texts
 
-def generate_conversation_audio(dialog_data, output_dir, agent):
-    """Generate audio for each turn in the conversation using AgentF5TTS"""
+def schedule_batches(chunks, max_frames_per_batch=DEFAULT_MAX_FRAMES_PER_BATCH):
+    """Pack turn chunks into batches of similar length whose padded mel frame count stays under the budget"""
+    batches = []
+    batch = []
+    for chunk in sorted(chunks, key=lambda c: -c.n_frames):
+        # Chunks come longest first, so the first chunk of a batch sets its padded length
+        if batch and (len(batch) + 1) * batch[0].n_frames > max_frames_per_batch:
+            batches.append(batch)
+            batch = []
+        batch.append(chunk)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def generate_conversation_audio(dialog_data, output_dir, agent, max_frames_per_batch=DEFAULT_MAX_FRAMES_PER_BATCH,
+                                rank=0, world_size=1):
+    """
+    Generate audio for each turn in the conversation using batched AgentF5TTS inference.
+
+    With world_size > 1 only every world_size-th turn starting at rank is generated, so
+    several workers can split one conversation without overlapping. Returns the paths
+    of the generated files.
+    """
     logging.info(f"Creating output directory at: {output_dir}")
     os.makedirs(output_dir, exist_ok=True)
     
-    speakers = dialog_data['Speaker'].unique()
-    
+    max_audios = 1000
+    turns = []
+
+    logging.info("Collecting dialog turns...")
+    # Plain column arrays of the capped rows: iterrows() would build a Series per row
+    capped = dialog_data.head(max_audios)
+    columns = [capped[column].to_numpy() for column in ('Speaker', 'Translated_Sentence', 'Dialog', 'Turn')]
+    for speaker, gen_text, dialog_id, turn in zip(*columns):  # gen_text is the text we want to generate
+        if not isinstance(gen_text, str) or not gen_text.strip():
+            logging.error(f"Empty sentence for Dialog {dialog_id}, Turn {turn}, skipping.")
+            continue
+
+        output_file = f"dialog_{dialog_id}_turn_{turn}_{speaker}.wav"
+        turns.append((gen_text.strip(), speaker, os.path.join(output_dir, output_file)))
+
+    turns = turns[rank::world_size]
+    if not turns:
+        logging.info("No dialog turns to generate.")
+        return []
+
     logging.info("Loading BR-Speech dataset...")
-    dataset = load_dataset("freds0/BRSpeech-TTS-Leni", split="test")
+    dataset = _get_dataset()
     
     logging.info("Assigning speaker voices...")
-    speaker_voices, speaker_texts = assign_speaker_voices(speakers, dataset)
-    
-    generated_count = 0
-    max_audios = 1000
+    # Every worker sees the same capped rows, so voices are assigned over all of their speakers
+    # alike, but only the references of this worker's speakers are decoded
+    speaker_voices, speaker_texts = assign_speaker_voices(
+        capped['Speaker'].unique(), dataset, needed={speaker for _, speaker, _ in turns}
+    )
+    if not speaker_voices:
+        logging.error("No speaker could be assigned a reference voice, nothing to generate.")
+        return []
+
+    # Resample/normalize each speaker's reference once, not once per turn, into one padded table
+    ref_table = SpeakerRefTable({
+        speaker: agent.prepare_reference(speaker_voices[speaker], speaker_texts[speaker], sr=24000)  # Using target sample rate of 24000 Hz
+        for speaker in speaker_voices
+    })
+
+    # Over-long sentences are generated in pieces that fit the model's context, then cross-faded back
+    chunks = []
+    for gen_text, speaker, output_path in turns:
+        pieces = agent.split_text(ref_table, speaker, gen_text)
+        for i, piece in enumerate(pieces):
+            n_frames = agent.estimate_frames(ref_table, speaker, piece)
+            chunks.append(TurnChunk(piece, speaker, output_path, n_frames, (i, len(pieces))))
 
-    logging.info("Starting audio generation for each dialog turn...")
-    for idx, row in dialog_data.iterrows():
-        if generated_count <= max_audios:           
-            speaker = row['Speaker']
-            gen_text = row['Translated_Sentence']  # This is the text we want to generate
-            ref_text = speaker_texts[speaker]      # This is the reference text from the dataset
-            dialog_id = row['Dialog']
-            turn = row['Turn']
-            
-            logging.info(f"Generating audio for Dialog {dialog_id}, Turn {turn}, Speaker {speaker}")
-            ref_audio = speaker_voices[speaker]
-
-            # Create temporary files for reference audio and text
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_ref_file:
-                temp_ref_path = temp_ref_file.name
-                sf.write(temp_ref_path, ref_audio, 24000)  # Using target sample rate of 24000 Hz
-            
-            with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as temp_text_file:
-                temp_text_path = temp_text_file.name
-                with open(temp_text_path, 'w', encoding='utf-8') as f:
-                    f.write(gen_text)
-        
-            try:
-                # Generate output filename
-                output_file = f"dialog_{dialog_id}_turn_{turn}_{speaker}.wav"
-                output_path = os.path.join(output_dir, output_file)
-                
-                # Generate audio using AgentF5TTS
-                agent.generate_speech(
-                    text_file=temp_text_path,  # Using the text file with the sentence to generate
-                    output_audio_file=output_path,
-                    ref_audio=temp_ref_path,  # Using the reference audio file
-                    ref_text=ref_text,  # Using the reference text
-                    convert_to_mp3=False
-                )
-                
-                logging.info(f"Generated audio for {output_file}")
-                generated_count += 1
-                
-            finally:
-                # Clean up temporary files
-                if os.path.exists(temp_ref_path):
-                    os.unlink(temp_ref_path)
-                if os.path.exists(temp_text_path):
-                    os.unlink(temp_text_path)
+    batches = schedule_batches(chunks, max_frames_per_batch)
+    failed = set()
+
+    logging.info(f"Starting audio generation for {len(turns)} dialog turns ({len(chunks)} chunks) in {len(batches)} batches...")
+    for batch_idx, batch in enumerate(batches):
+        # Chunks of a file that already failed in an earlier batch would never be written
+        batch = [c for c in batch if c.output_path not in failed]
+        if not batch:
+            continue
+        try:
+            agent.infer_batch(
+                table=ref_table,
+                speakers=[c.speaker for c in batch],
+                gen_texts=[c.gen_text for c in batch],
+                out_files=[c.output_path for c in batch],
+                parts=[c.part for c in batch]
+            )
+            logging.info(f"Generated batch {batch_idx + 1}/{len(batches)} ({len(batch)} chunks)")
+        except Exception as e:
+            logging.error(f"Error generating batch {batch_idx + 1}: {e}")
+            failed.update(c.output_path for c in batch)
+            # Release the chunks already generated for these files in earlier batches
+            agent.discard_parts(failed)
+    # Files are written in the background while the next batch generates; drop those whose write failed
+    failed.update(agent.wait_pending())
+
+    generated = [output_path for _, _, output_path in turns if output_path not in failed]
+    for output_path in generated:
+        logging.info(f"Generated audio for {os.path.basename(output_path)}")
+    return generated
+
+def _generate_on_gpu(rank, world_size, dialog_data, output_dir, ckpt_path, max_frames_per_batch, precision, compile,
+                     results):
+    """Worker process for one GPU: build its own agent and generate its shard of the turns"""
+    generated = []
+    try:
+        torch.cuda.set_device(rank)
+        agent = AgentF5TTS(
+            ckpt_file=ckpt_path,
+            vocoder_name="vocos",
+            delay=0,
+            device=f"cuda:{rank}",
+            precision=precision,
+            compile=compile
+        )
+        generated = generate_conversation_audio(
+            dialog_data,
+            output_dir,
+            agent,
+            max_frames_per_batch=max_frames_per_batch,
+            rank=rank,
+            world_size=world_size
+        )
+    finally:
+        # Always report back, so the parent never blocks on a failed worker
+        results.put(generated)
 
 def load_config(config_path):
     """Load configuration from YAML file"""
@@ -123,6 +220,9 @@ def main():
     parser = argparse.ArgumentParser(description="Generate conversation audio from dialog data using AgentF5TTS")
     parser.add_argument("--config", required=True, help="Path to config YAML file")
     parser.add_argument("--output_dir", required=True, help="Directory to save generated audio files")
+    parser.add_argument("--max_frames_per_batch", type=int, default=DEFAULT_MAX_FRAMES_PER_BATCH, help="Padded mel-frame budget (reference + generated) per F5-TTS forward pass")
+    parser.add_argument("--precision", choices=["fp32", "fp16", "bf16"], default=None, help="DiT weight precision, loaded straight from the checkpoint (default: F5-TTS picks FP16 on CUDA, FP32 elsewhere)")
+    parser.add_argument("--compile", action="store_true", help="Compile the DiT with torch.compile (dynamic shapes)")
     args = parser.parse_args()
     
     logging.info("Parsing arguments...")
@@ -133,23 +233,47 @@ def main():
     
     logging.info("Loading model...")
     # Load model using the Brazilian Portuguese checkpoint
-    ckpt_path = str(cached_path(DEFAULT_TTS_MODEL_CFG[0]))
+    ckpt_path = resolve_checkpoint(DEFAULT_TTS_MODEL_CFG[0])
     
     logging.info(f"Loading model from checkpoint: {ckpt_path}")
-    agent = AgentF5TTS(
-        ckpt_file=ckpt_path,
-        vocoder_name="vocos",
-        delay=0,
-        device="cuda"  # You can change this to "cpu" or "mps" based on your system
-    )
-    
-    logging.info("Beginning conversation audio generation...")
-    generate_conversation_audio(
-        dialog_data, 
-        args.output_dir, 
-        agent
-    )
-    logging.info("All audio generated successfully.")
+    world_size = torch.cuda.device_count()
+    if world_size > 1:
+        # Turns are independent, so each GPU gets its own model and a disjoint shard
+        logging.info(f"Beginning conversation audio generation on {world_size} GPUs...")
+        results = mp.get_context("spawn").SimpleQueue()
+        context = mp.spawn(
+            _generate_on_gpu,
+            args=(world_size, dialog_data, args.output_dir, ckpt_path, args.max_frames_per_batch, args.precision, args.compile,
+                  results),
+            nprocs=world_size,
+            join=False
+        )
+        # Drain results while polling the workers: join raises as soon as one fails or dies, instead
+        # of the parent waiting forever on a result that will never come
+        generated = []
+        while not context.join(timeout=1):
+            while not results.empty():
+                generated.extend(results.get())
+        while not results.empty():
+            generated.extend(results.get())
+    else:
+        agent = AgentF5TTS(
+            ckpt_file=ckpt_path,
+            vocoder_name="vocos",
+            delay=0,
+            device="cuda",  # You can change this to "cpu" or "mps" based on your system
+            precision=args.precision,
+            compile=args.compile
+        )
+
+        logging.info("Beginning conversation audio generation...")
+        generated = generate_conversation_audio(
+            dialog_data, 
+            args.output_dir, 
+            agent,
+            max_frames_per_batch=args.max_frames_per_batch
+        )
+    logging.info(f"All audio generated successfully ({len(generated)} files).")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file